@@ -0,0 +1,454 @@
+"""
+Бенчмарки скрапера на локальном тестовом сервере (без обращения к reflex-boutique.fr).
+
+Запуск:
+    python benchmarks.py connections [--pages 1000]
+    python benchmarks.py parse [--rounds 20]
+    python benchmarks.py parse-pool [--copies 40] [--max-workers N]
+    python benchmarks.py encoding [--rounds 5]
+    python benchmarks.py crawl [--rounds 5] [--parser lxml] [--regions-only] [--pipeline] [--history PATH] [--update-golden]
+
+Записанные страницы товаров лежат в fixtures/site/ (путь файла = путь URL на сайте), страницы категорий -
+в fixtures/categories/<путь URL>/page-N.html, эталонные записи parse_data - в fixtures/golden/products.jsonl.
+"""
+import argparse
+import contextlib
+import functools
+import glob
+import hashlib
+import io
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlparse, parse_qsl
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ftfy
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import parse_products as pp
+
+try:
+    import resource # только Unix: процессорное время дочерних процессов и пиковый RSS
+except ImportError:
+    resource = None
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SITE_URL = 'https://reflex-boutique.fr'
+CATEGORY_PATHS = ['/parquet-flottant/754-parquet-sol-stratifie', '/sol-vinyle/812-sol-vinyle-clipsable']
+
+
+class StandInServer:
+    """
+    Локальный HTTP/1.1 сервер с keep-alive, подменяющий сайт в бенчмарках.
+    handler(path, request_headers) -> (status, headers, body) или None (404).
+    Считает открытые TCP-соединения и ответы по кодам статуса.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.connections_opened = 0
+        self.status_counts = Counter()
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят одним пакетом, иначе keep-alive упирается в delayed ACK
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stand_in._lock: stand_in.connections_opened += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                result = stand_in.handler(self.path, self.headers)
+                status, headers, body = result if result else (404, {}, b'')
+                with stand_in._lock: stand_in.status_counts[status] += 1
+                self.send_response(status)
+                for name, value in headers.items(): self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        self._server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.connections_opened = 0
+            self.status_counts.clear()
+
+
+def configure_for_local_server():
+    """Снимает ограничения частоты и задержки повторов, рассчитанные на реальный сайт."""
+    pp.REQUESTS_PER_SECOND_PER_HOST = 1e9
+    pp.RATE_LIMIT_BURST = 1e9
+    pp.RETRY_BACKOFF_BASE = 0.01
+    pp._host_limiters.clear()
+
+
+def synthetic_product_page(n):
+    """Небольшая страница товара с уникальным содержимым."""
+    return (f'<html><head><meta charset="utf-8"></head><body><h1 class="h1">Parquet chêne n°{n}</h1>'
+            f'<div class="product-prices"><span class="current-price-value" content="{n}.90">{n},90 €</span></div>'
+            f'</body></html>').encode('utf-8')
+
+
+def load_product_fixtures():
+    """Записанные страницы товаров: список (url, html)."""
+    site_dir = os.path.join(FIXTURES_DIR, 'site')
+    pages = []
+    for root, _, files in os.walk(site_dir):
+        for name in sorted(files):
+            if name.endswith('.html'):
+                path = os.path.join(root, name)
+                url = SITE_URL + '/' + os.path.relpath(path, site_dir).replace(os.sep, '/')
+                with open(path, encoding='utf-8') as f: pages.append((url, f.read()))
+    return sorted(pages)
+
+def load_golden_products():
+    """Эталонные записи parse_data: {url: строка JSON}."""
+    with open(os.path.join(FIXTURES_DIR, 'golden', 'products.jsonl'), encoding='utf-8') as f:
+        return {json.loads(line)['url']: line.rstrip('\n') for line in f}
+
+
+def encoding_corpus():
+    """
+    Чистые и испорченные варианты записанных страниц: список (вариант, url, тело в байтах, заголовки ответа).
+    Для всех вариантов правильный результат parse_data - запись из эталона.
+    """
+    utf8 = {'Content-Type': 'text/html; charset=utf-8'}
+    variants = [
+        ('utf-8', lambda html: (html.encode('utf-8'), utf8)),
+        ('utf-8, charset только в <meta>', lambda html: (html.encode('utf-8'), {'Content-Type': 'text/html'})),
+        ('utf-8 с © и √ в подвале', lambda html: (html.replace('</body>', '<p>© Reflex · √ Livraison offerte</p></body>').encode('utf-8'), utf8)),
+        ('windows-1252 по заголовку', lambda html: (html.encode('cp1252', 'xmlcharrefreplace'), {'Content-Type': 'text/html; charset=windows-1252'})),
+        ('utf-8 по заголовку latin-1', lambda html: (html.encode('utf-8'), {'Content-Type': 'text/html; charset=ISO-8859-1'})),
+    ] + [
+        # Текст уже однажды прочитан не в той кодировке и сохранён сайтом в UTF-8: "ch√™ne", "chГЄne", "chÃªne"
+        (f'кракозябры {encoding}', lambda html, encoding=encoding: (html.encode('utf-8').decode(encoding).encode('utf-8'), utf8))
+        for encoding in ('mac_roman', 'cp1251', 'cp1252')
+    ]
+    corpus = []
+    for name, make in variants:
+        for url, html in load_product_fixtures():
+            content, headers = make(html)
+            corpus.append((name, url, content, CaseInsensitiveDict(headers)))
+    return corpus
+
+def legacy_decode(content, headers):
+    """Прежняя схема: кодировка как в requests.Response.text, ftfy.fix_text по всему документу по эвристике."""
+    encoding = requests.utils.get_encoding_from_headers(headers) or requests.compat.chardet.detect(content)['encoding'] or 'utf-8'
+    html = str(content, encoding, errors='replace')
+    if "√" in html and ("©" in html or "Г" in html): html = ftfy.fix_text(html)
+    return html
+
+def bench_encoding(args):
+    """
+    Декодирование + parse_data: ftfy по всему документу vs исправление отдельных полей; сверка с эталоном.
+    Отдельно - мс на страницу, потраченные только на кодировку (декодирование и исправление кракозябр).
+    """
+    golden = load_golden_products()
+    corpus = encoding_corpus()
+    fix_mojibake = pp.fix_mojibake
+    approaches = [
+        ('весь документ', legacy_decode, lambda text: text),
+        ('по полям', pp.decode_html, fix_mojibake),
+    ]
+    print(f'Страниц в корпусе: {len(corpus)}, проходов: {args.rounds}')
+    for variant in dict.fromkeys(name for name, *_ in corpus):
+        pages = [(url, content, headers) for name, url, content, headers in corpus if name == variant]
+        print(f'  {variant}')
+        for title, decode, fix in approaches:
+            pp.fix_mojibake = fix # parse_data берёт fix_mojibake из модуля
+            try:
+                mismatches = sum(json.dumps(pp.parse_data(decode(content, headers), url), ensure_ascii=False) != golden[url]
+                                 for url, content, headers in pages)
+                encoding_time = 0
+                started = time.perf_counter()
+                for _ in range(args.rounds):
+                    fix_mojibake.cache_clear() # без накопленного кэша полей: стоимость первого прохода
+                    for url, content, headers in pages:
+                        decode_started, timings = time.perf_counter(), {}
+                        html = decode(content, headers)
+                        encoding_time += time.perf_counter() - decode_started
+                        pp.parse_data(html, url, timings)
+                        encoding_time += timings['mojibake']
+                elapsed = time.perf_counter() - started
+            finally:
+                pp.fix_mojibake = fix_mojibake
+            page_count = len(pages) * args.rounds
+            print(f'    {title:<14} {page_count / elapsed:6.1f} стр/с, на кодировку {encoding_time * 1000 / page_count:6.2f} мс/стр, '
+                  f'расхождений с эталоном: {mismatches}')
+
+
+@functools.lru_cache(maxsize=None)
+def read_fixture(path):
+    """Тело записанной страницы в байтах или None, если такой страницы нет."""
+    if not os.path.isfile(path): return None
+    with open(path, 'rb') as f: return f.read()
+
+def fixture_site_handler(path, request_headers):
+    """
+    Обработчик StandInServer, отдающий записанный сайт: товары из fixtures/site/, категории из
+    fixtures/categories/ (?page=N -> page-N.html). Ссылки на SITE_URL в страницах указывают на сам сервер.
+    """
+    parsed = urlparse(path)
+    parts = [part for part in parsed.path.split('/') if part and part != '..']
+    if parsed.path.endswith('.html'):
+        file_path = os.path.join(FIXTURES_DIR, 'site', *parts)
+    else:
+        page = dict(parse_qsl(parsed.query)).get('page', '1')
+        file_path = os.path.join(FIXTURES_DIR, 'categories', *parts, f'page-{page}.html')
+    body = read_fixture(file_path)
+    if body is None: return None
+    body = body.replace(SITE_URL.encode(), f'http://{request_headers["Host"]}'.encode())
+    return 200, {'Content-Type': 'text/html; charset=utf-8'}, body
+
+def cpu_seconds():
+    """Процессорное время этого процесса и завершившихся дочерних (пул разбора)."""
+    if not resource: return time.process_time()
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+def peak_rss_mb():
+    """Пиковый RSS процесса бенчмарка (или его дочерних процессов, если больше), МБ; None без resource."""
+    if not resource: return None
+    peak = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return peak / 1024 ** (2 if sys.platform == 'darwin' else 1) # ru_maxrss: байты на macOS, КБ на Linux
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_with_golden(records, golden):
+    """Сверка записей обхода с эталоном: (расходятся, нет в выводе, лишние) - списки URL."""
+    by_url = {record['url']: record for record in records}
+    mismatched = [url for url in golden if url in by_url and by_url[url] != json.loads(golden[url])]
+    return mismatched, [url for url in golden if url not in by_url], [url for url in by_url if url not in golden]
+
+def write_golden_products(records):
+    path = os.path.join(FIXTURES_DIR, 'golden', 'products.jsonl')
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in sorted(records, key=lambda record: record['url']):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f'Эталон обновлён: {path} ({len(records)} записей)')
+
+def bench_crawl(args):
+    """
+    Полный обход как в main() по записанному сайту: категории (с пагинацией и повторами товаров),
+    загрузка и разбор товаров, запись JSONL. Страниц/с, процессорное время на страницу, пиковый RSS
+    и сверка вывода с эталоном. Код возврата 1, если вывод расходится с эталоном.
+    """
+    configure_for_local_server()
+    pp.INCREMENTAL_SCRAPE, pp.HTTP_CACHE_MODE, pp.SITEMAP_URL = False, 'off', None
+    pp.OUTPUT_FORMAT, pp.OUTPUT_COMPRESSION = 'jsonl', None
+    pp.PARSER_BACKEND, pp.PARSE_PRODUCT_REGIONS_ONLY, pp.PARSE_IN_PROCESS_POOL = args.parser, args.regions_only, args.pipeline
+    golden = load_golden_products()
+    rounds = []
+    previous_dir = os.getcwd()
+    with StandInServer(fixture_site_handler) as server, tempfile.TemporaryDirectory() as work_dir:
+        pp.CATEGORY_URLS = [server.base_url + path for path in CATEGORY_PATHS]
+        try:
+            for n in range(args.rounds):
+                round_dir = os.path.join(work_dir, f'round-{n}') # у каждого прохода свой файл вывода и контрольная точка
+                os.makedirs(round_dir)
+                os.chdir(round_dir)
+                server.reset_counters()
+                cpu_started, started = cpu_seconds(), time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()): pp.main()
+                elapsed, cpu = time.perf_counter() - started, cpu_seconds() - cpu_started
+                records = []
+                for output_path in glob.glob(os.path.join(round_dir, '*', '*.jsonl')):
+                    with open(output_path, encoding='utf-8') as f:
+                        records.extend(json.loads(line.replace(server.base_url, SITE_URL)) for line in f)
+                rounds.append((elapsed, cpu, sum(server.status_counts.values()), records))
+        finally:
+            os.chdir(previous_dir)
+
+    records = rounds[0][3]
+    if args.update_golden:
+        write_golden_products(records)
+        golden = load_golden_products()
+    mismatched, missing, unexpected = compare_with_golden(records, golden)
+    pages = rounds[0][2]
+    wall = statistics.median(elapsed for elapsed, *_ in rounds)
+    cpu_per_page = statistics.median(cpu / page_count for _, cpu, page_count, _ in rounds)
+    rss = peak_rss_mb()
+    print(f'Обход записанного сайта: категорий {len(CATEGORY_PATHS)}, страниц за проход {pages}, товаров {len(records)}, проходов {args.rounds}')
+    print(f'  парсер {args.parser}{", только области товара" if args.regions_only else ""}{", пул процессов" if args.pipeline else ""}')
+    print(f'  {pages / wall:.1f} стр/с (медиана, лучший проход {pages / min(elapsed for elapsed, *_ in rounds):.1f}), '
+          f'процессор {cpu_per_page * 1000:.2f} мс/стр, пиковый RSS {f"{rss:.1f} МБ" if rss else "н/д"}')
+    print(f'  сверка с эталоном: расходятся {len(mismatched)}, нет в выводе {len(missing)}, лишние {len(unexpected)}')
+    for url in mismatched + missing + unexpected: print(f'    {url}')
+    if args.history:
+        entry = {'date': datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+                 'parser': args.parser, 'regions_only': args.regions_only, 'pipeline': args.pipeline,
+                 'pages_per_s': round(pages / wall, 2), 'cpu_ms_per_page': round(cpu_per_page * 1000, 3),
+                 'peak_rss_mb': round(rss, 1) if rss else None, 'golden_mismatches': len(mismatched + missing + unexpected)}
+        with open(args.history, 'a', encoding='utf-8') as f: f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        print(f'  результат добавлен в {args.history}')
+    return 1 if mismatched or missing or unexpected else 0
+
+
+def bench_connections(args):
+    """Сколько TCP-соединений открывается на N страниц: requests.get по одной vs общая сессия с пулом."""
+    configure_for_local_server()
+    failed_once = set()
+    failed_lock = threading.Lock()
+
+    def handler(path, request_headers):
+        if not path.startswith('/p/'): return None
+        n = int(path.split('/')[2])
+        # Каждая 50-я страница с первого раза отвечает 503, чтобы проверить повторы
+        if args.flaky and n % 50 == 0:
+            with failed_lock:
+                if n not in failed_once:
+                    failed_once.add(n)
+                    return 503, {'Retry-After': '0'}, b''
+        body = synthetic_product_page(n)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if request_headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'Content-Type': 'text/html; charset=utf-8', 'ETag': etag}, body
+
+    validators = {} # ETag первого прохода, как их сохранил бы ScrapeState
+    with StandInServer(handler) as server:
+        urls = [f'{server.base_url}/p/{n}' for n in range(1, args.pages + 1)]
+
+        def fetch_without_session(url):
+            return requests.get(url, headers=pp.REQUEST_HEADERS, timeout=pp.HTTP_TIMEOUT).content
+
+        def fetch_first(url):
+            page = pp.fetch_product_page(url)
+            if page.validators: validators[url] = page.validators
+            return page.html
+
+        def fetch_repeat(url):
+            page = pp.fetch_product_page(url, {}, validators)
+            return page.html or page.unchanged
+
+        runs = [
+            ('requests.get на каждую страницу', fetch_without_session),
+            ('общая сессия (первый проход)', fetch_first),
+            ('общая сессия (повтор, условные запросы)', fetch_repeat),
+        ]
+        print(f'Страниц: {args.pages}, потоков: {pp.MAX_CONCURRENT_REQUESTS}')
+        for title, fetch in runs:
+            server.reset_counters()
+            failed_once.clear()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=pp.MAX_CONCURRENT_REQUESTS) as executor:
+                results = list(executor.map(fetch, urls))
+            elapsed = time.perf_counter() - started
+            missing = sum(1 for r in results if not r)
+            print(f'  {title}: соединений {server.connections_opened} '
+                  f'({server.connections_opened * 1000 / args.pages:.1f} на 1000 страниц), '
+                  f'ответы {dict(sorted(server.status_counts.items()))}, {args.pages / elapsed:.0f} стр/с, без ответа {missing}')
+
+
+def bench_parse(args):
+    """Страниц в секунду для parse_data с каждым парсером, с частичным разбором и без; сверка с эталоном."""
+    pages = load_product_fixtures()
+    golden = load_golden_products()
+    backends = ['html.parser', 'lxml']
+    print(f'Страниц в наборе: {len(pages)}, проходов: {args.rounds}')
+    for backend, regions_only in itertools.product(backends, [False, True]):
+        pp.PARSER_BACKEND, pp.PARSE_PRODUCT_REGIONS_ONLY = backend, regions_only
+        if pp.get_parser_backend() != backend: continue
+        mismatches = sum(json.dumps(pp.parse_data(html, url), ensure_ascii=False) != golden.get(url) for url, html in pages)
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for url, html in pages: pp.parse_data(html, url)
+        elapsed = time.perf_counter() - started
+        print(f'  {backend:<12} {"только области товара" if regions_only else "вся страница":<22} '
+              f'{len(pages) * args.rounds / elapsed:7.1f} стр/с, расхождений с эталоном: {mismatches}')
+
+
+def bench_parse_pool(args):
+    """Пропускная способность разбора в пуле процессов конвейера в зависимости от числа процессов."""
+    golden = load_golden_products()
+    corpus = [pp.FetchedPage(url, html, None, False, None) for url, html in load_product_fixtures()] * args.copies
+    max_workers = args.max_workers or os.cpu_count() or 1
+    worker_counts = sorted({1, max_workers} | {n for n in (2, 4, 8, 16, 32) if n < max_workers})
+    print(f'Страниц: {len(corpus)}, ядер: {os.cpu_count()}, парсер: {pp.get_parser_backend()}')
+    baseline = None
+    for workers in worker_counts:
+        with ProcessPoolExecutor(max_workers=workers, initializer=pp.init_parse_worker,
+                                 initargs=(pp.PARSER_BACKEND, pp.PARSE_PRODUCT_REGIONS_ONLY)) as executor:
+            list(executor.map(pp.parse_product_page, corpus[:workers])) # прогрев процессов
+            started = time.perf_counter()
+            results = list(executor.map(pp.parse_product_page, corpus, chunksize=4))
+            elapsed = time.perf_counter() - started
+        mismatches = sum(json.dumps(r.data, ensure_ascii=False) != golden[page.url] for page, r in zip(corpus, results))
+        throughput = len(corpus) / elapsed
+        baseline = baseline or throughput
+        print(f'  процессов {workers:>2}: {throughput:7.1f} стр/с (x{throughput / baseline:.2f}), '
+              f'расхождений с эталоном: {mismatches}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    connections = commands.add_parser('connections', help='соединения на 1000 страниц: requests.get vs пул сессии')
+    connections.add_argument('--pages', type=int, default=1000)
+    connections.add_argument('--no-flaky', dest='flaky', action='store_false',
+                             help='не отвечать 503 на каждую 50-ю страницу')
+    connections.set_defaults(func=bench_connections)
+
+    parse = commands.add_parser('parse', help='скорость parse_data по парсерам на записанных страницах')
+    parse.add_argument('--rounds', type=int, default=20)
+    parse.set_defaults(func=bench_parse)
+
+    parse_pool = commands.add_parser('parse-pool', help='масштабирование разбора по числу процессов')
+    parse_pool.add_argument('--copies', type=int, default=40, help='сколько раз повторить набор страниц')
+    parse_pool.add_argument('--max-workers', type=int, default=None, help='по умолчанию - число ядер')
+    parse_pool.set_defaults(func=bench_parse_pool)
+
+    encoding = commands.add_parser('encoding', help='исправление кодировки: весь документ vs отдельные поля')
+    encoding.add_argument('--rounds', type=int, default=5)
+    encoding.set_defaults(func=bench_encoding)
+
+    crawl = commands.add_parser('crawl', help='полный обход записанного сайта: стр/с, CPU, RSS, сверка с эталоном')
+    crawl.add_argument('--rounds', type=int, default=5)
+    crawl.add_argument('--parser', choices=['html.parser', 'lxml'], default=pp.PARSER_BACKEND)
+    crawl.add_argument('--regions-only', action='store_true', help='PARSE_PRODUCT_REGIONS_ONLY')
+    crawl.add_argument('--pipeline', action='store_true', help='разбор в пуле процессов (PARSE_IN_PROCESS_POOL)')
+    crawl.add_argument('--history', metavar='PATH', help='дописать результат строкой JSON, чтобы следить за динамикой')
+    crawl.add_argument('--update-golden', action='store_true',
+                       help='перезаписать fixtures/golden/products.jsonl выводом обхода (после намеренной правки разбора)')
+    crawl.set_defaults(func=bench_crawl)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
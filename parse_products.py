@@ -1,57 +1,629 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.structures import CaseInsensitiveDict
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer, Tag
 import csv
+import io
+import glob
 from datetime import datetime
 import ftfy 
+from ftfy.badness import is_bad as has_mojibake
+import codecs
+import functools
+import unicodedata
+import gzip
+import hashlib
+import mimetypes
+import tempfile
+import inspect
+import sqlite3
 import json 
+import argparse
+import cProfile
+import pstats
+import math
 import re 
 import os 
 import time 
+import random
+import threading
+import multiprocessing
+from collections import Counter, deque, namedtuple
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlparse, urljoin, urldefrag, parse_qsl, urlencode, urlunparse
+import xml.etree.ElementTree as ElementTree
+try:
+    import zstandard # необязательно, только для OUTPUT_COMPRESSION = 'zstd'
+except ImportError:
+    zstandard = None
 
 # URL СТАРТОВОЙ СТРАНИЦЫ КАТЕГОРИИ ДЛЯ СКАНИРОВАНИЯ
 START_CATEGORY_URL = 'https://reflex-boutique.fr/parquet-flottant/754-parquet-sol-stratifie'
 
+# ЧТО СКАНИРОВАТЬ: НЕСКОЛЬКО КАТЕГОРИЙ И/ИЛИ SITEMAP (товары без повторов)
+CATEGORY_URLS = [START_CATEGORY_URL]
+SITEMAP_URL = None                 # например 'https://reflex-boutique.fr/1_index_sitemap.xml'
+SITEMAP_PRODUCT_URL_PATTERN = r'/\d+-[^/]+\.html$' # товары PrestaShop: /категория/123-название.html
+PARALLEL_PAGINATION = True         # узнав число страниц категории, загружать страницы 2..N параллельно
+MULTI_SOURCE_FOLDER_NAME = 'reflex_boutique' # папка вывода, если категорий несколько или используется sitemap
 
-def fetch_page_content(url_to_fetch):
-    """Загружает HTML-содержимое страницы и исправляет кодировку, если нужно."""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept-Language': 'fr-FR,fr;q=0.9,en-US;q=0.8,en;q=0.7,ru;q=0.6', 
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-    }
+# ПАРАЛЛЕЛЬНАЯ ЗАГРУЗКА СТРАНИЦ ТОВАРОВ
+CONCURRENT_FETCH = True            # False - загружать товары строго по одному, как раньше
+MAX_CONCURRENT_REQUESTS = 8        # максимум одновременных запросов "в полёте"
+REQUESTS_PER_SECOND_PER_HOST = 3.0 # средняя частота запросов к одному хосту (token bucket)
+RATE_LIMIT_BURST = 4               # сколько запросов подряд можно отправить без ожидания
+
+# HTTP-СЕССИЯ: ПУЛ СОЕДИНЕНИЙ, ПОВТОРЫ, УСЛОВНЫЕ ЗАПРОСЫ
+HTTP_POOL_SIZE = MAX_CONCURRENT_REQUESTS # keep-alive соединений на один хост
+HTTP_TIMEOUT = 20                  # таймаут одного запроса, сек
+MAX_RETRIES = 4                    # повторов после первой неудачной попытки
+RETRY_BACKOFF_BASE = 1.0           # базовая задержка экспоненциального backoff, сек
+RETRY_BACKOFF_MAX = 60.0           # верхняя граница задержки (и для Retry-After), сек
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+USE_CONDITIONAL_REQUESTS = True    # If-None-Match / If-Modified-Since для товаров по ETag/Last-Modified из прошлого запуска
+
+# ДИСКОВЫЙ КЭШ HTTP-ОТВЕТОВ (удобно при отладке селекторов в parse_data)
+HTTP_CACHE_MODE = 'off'            # 'off' - без кэша, 'use' - кэш + сеть, 'replay' - только кэш, без сети
+HTTP_CACHE_DIR = '.http_cache'
+HTTP_CACHE_TTL = 24 * 3600         # сколько секунд ответ считается свежим (устаревший перепроверяется условным запросом)
+HTTP_CACHE_MAX_BYTES = 2 * 1024 ** 3 # при превышении удаляются давно не читанные записи (LRU)
+
+# ИНКРЕМЕНТАЛЬНЫЙ ПЕРЕСКАН: НЕИЗМЕНИВШИЕСЯ СТРАНИЦЫ НЕ РАЗБИРАЮТСЯ ЗАНОВО
+INCREMENTAL_SCRAPE = True          # хранить состояние между запусками и писать файл изменений (delta)
+STATE_DB_FILENAME = 'scrape_state.sqlite3' # создаётся в папке категории
+
+# РАЗБОР HTML
+PARSER_BACKEND = 'html.parser'     # 'html.parser' или 'lxml' (заметно быстрее, нужен pip install lxml)
+PARSE_PRODUCT_REGIONS_ONLY = False # строить дерево только из областей товара, которые читает parse_data
+
+# КОДИРОВКА
+CHARSET_SNIFF_BYTES = 4096         # в скольких первых байтах страницы искать <meta charset>
+MOJIBAKE_CACHE_SIZE = 2048         # сколько текстовых полей помнить в кэше fix_mojibake
+MOJIBAKE_ENCODINGS = ('cp1252', 'mac_roman', 'cp1251') # в каких кодировках UTF-8 текст сайта бывает прочитан по ошибке
+
+# КОНВЕЙЕР: ПОТОКИ ЗАГРУЖАЮТ СТРАНИЦЫ, ОТДЕЛЬНЫЕ ПРОЦЕССЫ ИХ РАЗБИРАЮТ
+PARSE_IN_PROCESS_POOL = False      # разбирать parse_data в пуле процессов (на всех ядрах), а не в потоках загрузки
+PARSE_WORKERS = os.cpu_count() or 1 # процессов разбора
+PARSE_QUEUE_SIZE = 64              # максимум загруженных страниц, ожидающих разбора (ограничивает память)
+
+# ВЫВОД: ЗАПИСИ ПИШУТСЯ В ФАЙЛ ПО МЕРЕ РАЗБОРА
+OUTPUT_FORMAT = 'csv'              # 'csv' или 'jsonl' (JSON Lines)
+OUTPUT_COMPRESSION = None          # None, 'gzip' или 'zstd' (нужен pip install zstandard)
+OUTPUT_FLUSH_EVERY = 50            # записей между сбросами на диск
+OUTPUT_RESUME = True               # дописывать в незавершённый файл прошлого запуска, пропуская записанные товары
+
+# КОНТРОЛЬНЫЕ ТОЧКИ ДЛЯ ДОЛГИХ ОБХОДОВ (python parse_products.py --resume)
+CHECKPOINT_FILE = 'scrape_checkpoint.json' # список товаров, пройденные источники, файл вывода
+
+# ЗАГРУЗКА ИЗОБРАЖЕНИЙ ТОВАРОВ (также --download-images)
+DOWNLOAD_IMAGES = False            # скачивать image_url каждого товара, локальный путь пишется в колонку image_path
+IMAGES_DIR = 'images'              # создаётся в папке категории, файлы именуются по sha256 содержимого
+IMAGE_INDEX_FILENAME = 'images_index.json' # в IMAGES_DIR: URL -> файл, sha256, ETag/Last-Modified
+MAX_CONCURRENT_IMAGE_DOWNLOADS = 4 # одновременных загрузок изображений (сверх MAX_CONCURRENT_REQUESTS)
+IMAGE_CHUNK_SIZE = 64 * 1024       # изображение пишется на диск блоками этого размера, целиком в памяти не держится
+
+# МЕТРИКИ И ПРОФИЛИРОВАНИЕ (также --metrics-json и --profile-parse)
+METRICS_JSON_PATH = None           # куда сохранить сводку метрик в JSON
+PROFILE_PARSE_PATH = None          # куда сохранить статистику cProfile по parse_data (.prof)
+
+PRODUCT_FIELDNAMES = ['url', 'title', 'category', 'price', 
+                      'short_description', 'full_description_html', 'product_details_html',
+                      'image_url']
+IMAGE_FIELDNAMES = ['image_path']   # добавляются к PRODUCT_FIELDNAMES при DOWNLOAD_IMAGES
+TEXT_FIELDS = ['title', 'category', 'short_description', 'full_description_html', 'product_details_html'] # проверяются fix_mojibake
+
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept-Language': 'fr-FR,fr;q=0.9,en-US;q=0.8,en;q=0.7,ru;q=0.6', 
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+}
+
+
+class ScrapeMetrics:
+    """
+    Метрики запуска: длительности по стадиям (connect, tls, ttfb, download, decode, parse, strip,
+    write) и счётчики (запросы, байты, повторы, попадания в кэш, 304). Потокобезопасно.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.perf_counter()
+            self.timings = {}
+            self.counters = {}
+
+    def add_timing(self, stage, seconds):
+        with self._lock:
+            self.timings.setdefault(stage, []).append(seconds)
+
+    def add_timings(self, timings):
+        for stage, seconds in timings.items(): self.add_timing(stage, seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @staticmethod
+    def percentile(sorted_values, fraction):
+        return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+    def summary(self):
+        """Сводка: p50/p95/p99 и сумма по каждой стадии (мс), счётчики, страниц товаров в секунду."""
+        with self._lock:
+            elapsed = time.perf_counter() - self.started
+            stages = {}
+            for stage, values in self.timings.items():
+                values = sorted(values)
+                stages[stage] = {
+                    'count': len(values), 'total_ms': round(sum(values) * 1000, 1),
+                    **{f'p{q}_ms': round(self.percentile(values, q / 100) * 1000, 2) for q in (50, 95, 99)},
+                }
+            return {'elapsed_s': round(elapsed, 3), 'pages_per_s': round(self.counters.get('products', 0) / elapsed, 2) if elapsed else 0,
+                    'counters': dict(self.counters), 'stages': stages}
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"\n--- Метрики: {summary['elapsed_s']} с, {summary['pages_per_s']} товаров/с ---")
+        print("  " + ", ".join(f"{name}: {value}" for name, value in sorted(summary['counters'].items())))
+        print(f"  {'стадия':<10} {'кол-во':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'всего, с':>9}")
+        for stage, st in summary['stages'].items():
+            print(f"  {stage:<10} {st['count']:>7} {st['p50_ms']:>9} {st['p95_ms']:>9} {st['p99_ms']:>9} {st['total_ms'] / 1000:>9.2f}")
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+        print(f"Метрики сохранены в {path}")
+
+metrics = ScrapeMetrics()
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов: не более `rate` запросов в секунду, пачками до `capacity`."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Забирает один токен, при необходимости ждёт его появления."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1 # токен резервируется сразу, ожидающие потоки встают в очередь
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait: time.sleep(wait)
+
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+def wait_for_rate_limit(url):
+    """Соблюдает ограничение частоты запросов для хоста из url."""
+    host = urlparse(url).netloc
+    with _host_limiters_lock:
+        limiter = _host_limiters.get(host)
+        if limiter is None:
+            limiter = _host_limiters[host] = TokenBucket(REQUESTS_PER_SECOND_PER_HOST, RATE_LIMIT_BURST)
+    limiter.acquire()
+
+
+_connection_setup = threading.local() # seconds - установка соединений в текущем запросе этого потока
+
+class ConnectTimingMixin:
+    """
+    Замеряет установку TCP-соединения (DNS + connect) и, для HTTPS, TLS-рукопожатие.
+    Общее время установки копится в _connection_setup.seconds, http_get вычитает его из ttfb.
+    """
+    _tcp_seconds = 0.0
+
+    def _new_conn(self):
+        started = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            self._tcp_seconds = time.perf_counter() - started
+            metrics.add_timing('connect', self._tcp_seconds)
+            metrics.count('connections')
+
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        setup_seconds = time.perf_counter() - started
+        if isinstance(self, HTTPSConnection):
+            metrics.add_timing('tls', setup_seconds - self._tcp_seconds)
+        _connection_setup.seconds = getattr(_connection_setup, 'seconds', 0.0) + setup_seconds
+
+class TimedHTTPConnection(ConnectTimingMixin, HTTPConnection): pass
+class TimedHTTPSConnection(ConnectTimingMixin, HTTPSConnection): pass
+class TimedHTTPConnectionPool(HTTPConnectionPool): ConnectionCls = TimedHTTPConnection
+class TimedHTTPSConnectionPool(HTTPSConnectionPool): ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter, соединения которого отчитываются о времени установки в metrics."""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_http_session():
+    """Возвращает общую для всех потоков requests.Session с пулом keep-alive соединений."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            # Повторы делает http_get сам (с jitter и Retry-After), поэтому max_retries=0
+            pool_size = HTTP_POOL_SIZE + (MAX_CONCURRENT_IMAGE_DOWNLOADS if DOWNLOAD_IMAGES else 0)
+            adapter = TimedHTTPAdapter(pool_connections=10, pool_maxsize=pool_size, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(REQUEST_HEADERS)
+            _session = session
+        return _session
+
+
+def parse_retry_after(value):
+    """Переводит заголовок Retry-After (секунды или HTTP-дата) в секунды ожидания; None, если не разобрать."""
+    if not value: return None
+    value = value.strip()
+    if value.isdigit(): return float(value)
     try:
-        # print(f"  Загрузка: {url_to_fetch}") 
-        response = requests.get(url_to_fetch, headers=headers, timeout=20)
-        response.raise_for_status() 
-        html_text = response.text
-        if "√" in html_text and ("©" in html_text or "Г" in html_text): 
-            fixed_text = ftfy.fix_text(html_text)
-            return fixed_text
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def backoff_delay(attempt, retry_after=None):
+    """Задержка перед повтором номер attempt (с 0): Retry-After, если сервер его прислал, иначе full jitter."""
+    if retry_after is not None:
+        return min(retry_after, RETRY_BACKOFF_MAX)
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+def wire_size(response, decoded_size):
+    """
+    Сколько байт тела пришло по сети (до распаковки gzip/br), если тело уже прочитано.
+    urllib3 считает их в raw.tell(); если это недоступно, возвращается decoded_size.
+    """
+    try: return response.raw.tell() or decoded_size
+    except (AttributeError, OSError): return decoded_size
+
+def http_get(url, headers=None, stream=False):
+    """
+    GET через общую сессию с ограничением частоты и повторами.
+    Повторяет таймауты, обрывы соединения и ответы RETRY_STATUS_CODES; после MAX_RETRIES
+    возвращает последний ответ (или пробрасывает последнее исключение).
+    stream=True: тело не читается, его забирает вызывающий (iter_content) и закрывает ответ сам.
+    bytes_downloaded - байты тела по сети, а не размер после распаковки.
+    """
+    session = get_http_session()
+    for attempt in range(MAX_RETRIES + 1):
+        wait_for_rate_limit(url)
+        metrics.count('requests')
+        if attempt: metrics.count('retries')
+        _connection_setup.seconds = 0.0
+        started = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, timeout=HTTP_TIMEOUT, stream=stream)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            metrics.count('request_errors')
+            if attempt == MAX_RETRIES: raise
+            delay = backoff_delay(attempt)
+            print(f"    Повтор {attempt+1}/{MAX_RETRIES} через {delay:.1f} с ({url}): {e}")
         else:
-            return html_text
+            # elapsed у requests - время до получения заголовков, остальное - чтение тела. В elapsed входит
+            # и установка нового соединения; она уже учтена в connect/tls, поэтому из ttfb вычитается
+            headers_seconds = response.elapsed.total_seconds()
+            metrics.add_timing('ttfb', max(0.0, headers_seconds - _connection_setup.seconds))
+            if not stream:
+                metrics.add_timing('download', max(0.0, time.perf_counter() - started - headers_seconds))
+                metrics.count('bytes_downloaded', wire_size(response, len(response.content)))
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                return response
+            delay = backoff_delay(attempt, parse_retry_after(response.headers.get('Retry-After')))
+            print(f"    Повтор {attempt+1}/{MAX_RETRIES} через {delay:.1f} с ({url}): HTTP {response.status_code}")
+            response.close()
+        time.sleep(delay)
+
+
+def conditional_headers(stored_headers):
+    """Заголовки If-None-Match / If-Modified-Since по сохранённому ответу."""
+    headers = {}
+    if stored_headers.get('ETag'): headers['If-None-Match'] = stored_headers['ETag']
+    if stored_headers.get('Last-Modified'): headers['If-Modified-Since'] = stored_headers['Last-Modified']
+    return headers
+
+def response_validators(headers):
+    """ETag/Last-Modified ответа для следующего условного запроса или None, если сервер их не прислал."""
+    if not (headers.get('ETag') or headers.get('Last-Modified')): return None
+    return {'ETag': headers.get('ETag'), 'Last-Modified': headers.get('Last-Modified')}
+
+class NotModified(Exception):
+    """Сервер ответил 304 на условный запрос по validators, переданным в fetch_raw: тела нет."""
+
+class CacheMissError(requests.exceptions.RequestException):
+    """Страницы нет в кэше, а сеть отключена (HTTP_CACHE_MODE = 'replay')."""
+
+
+class HttpCache:
+    """
+    Дисковый кэш ответов: один gzip-файл на URL (имя - sha256 от URL), внутри строка JSON
+    с заголовками и временем загрузки, затем тело ответа. Время изменения файла обновляется
+    при каждом чтении, по нему при переполнении удаляются самые давно не читанные записи.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._total_bytes = None # считается при первой записи
+        self._lock = threading.Lock()
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.gz')
+
+    def get(self, url):
+        """Возвращает (тело, заголовки, время загрузки) или None."""
+        path = self._path(url)
+        try:
+            with gzip.open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                content = f.read()
+            os.utime(path)
+        except (OSError, EOFError, ValueError):
+            return None
+        return content, CaseInsensitiveDict(meta['headers']), meta['stored_at']
+
+    def put(self, url, content, headers):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {'url': url, 'stored_at': time.time(), 'headers': dict(headers)}
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+            f.write(json.dumps(meta, ensure_ascii=False).encode('utf-8') + b'\n')
+            f.write(content)
+        new_size = os.path.getsize(tmp_path)
+        with self._lock:
+            if self._total_bytes is None: self._total_bytes = self._scan_size()
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self._total_bytes += new_size - old_size
+            if self._total_bytes > self.max_bytes: self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.gz'):
+                    path = os.path.join(root, name)
+                    try: yield path, os.stat(path)
+                    except OSError: pass
+
+    def _scan_size(self):
+        return sum(st.st_size for _, st in self._entries())
+
+    def _evict(self):
+        """Удаляет самые давно не читанные записи, пока кэш не займёт не больше 90% лимита."""
+        target = self.max_bytes * 0.9
+        for path, st in sorted(self._entries(), key=lambda entry: entry[1].st_mtime):
+            if self._total_bytes <= target: break
+            try:
+                os.remove(path)
+                self._total_bytes -= st.st_size
+            except OSError:
+                pass
+
+_http_cache = None
+_http_cache_lock = threading.Lock()
+
+def get_http_cache():
+    """Дисковый кэш ответов или None, если HTTP_CACHE_MODE = 'off'."""
+    global _http_cache
+    if HTTP_CACHE_MODE == 'off': return None
+    with _http_cache_lock:
+        if _http_cache is None: _http_cache = HttpCache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_BYTES)
+        return _http_cache
+
+def fetch_raw(url, validators=None):
+    """
+    Загружает url и возвращает (тело в байтах, заголовки ответа).
+    Свежий ответ из дискового кэша возвращается без запроса; для устаревшего отправляется
+    условный запрос, на 304 возвращается тело из кэша. Если в кэше ничего нет, условный запрос
+    строится по validators (ETag/Last-Modified из прошлого запуска), и на 304 поднимается NotModified.
+    Ошибки HTTP пробрасываются как requests.exceptions.RequestException.
+    """
+    cache = get_http_cache()
+    cached = cache.get(url) if cache else None
+    if cached:
+        content, headers, stored_at = cached
+        if HTTP_CACHE_MODE == 'replay' or time.time() - stored_at < HTTP_CACHE_TTL:
+            metrics.count('cache_hits')
+            return content, headers
+        stored = (content, headers)
+    elif HTTP_CACHE_MODE == 'replay':
+        raise CacheMissError(f"нет в кэше {HTTP_CACHE_DIR}: {url}")
+    else:
+        stored = None
+    if stored: validators = stored[1]
+    elif not USE_CONDITIONAL_REQUESTS: validators = None
+
+    response = http_get(url, headers=conditional_headers(validators) if validators else None)
+    if validators and response.status_code == 304:
+        metrics.count('not_modified')
+        if not stored: raise NotModified(url)
+        if cache: cache.put(url, *stored) # страница не изменилась - продлеваем срок жизни записи
+        return stored
+    response.raise_for_status()
+    content = response.content
+    if cache: cache.put(url, content, response.headers)
+    return content, response.headers
+
+_HEADER_CHARSET_RE = re.compile(r'charset\s*=\s*["\']?\s*([-\w.:]+)', re.I)
+_META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([-\w.:]+)', re.I)
+_BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+# Как в браузерах: страницы с "latin-1"/"ascii" на деле почти всегда в windows-1252 (€, «’», «–»)
+_CHARSET_ALIASES = {'iso8859-1': 'cp1252', 'ascii': 'cp1252'}
+
+def normalize_charset(name):
+    """Каноническое имя кодировки или None, если Python её не знает."""
+    try: encoding = codecs.lookup(name).name
+    except LookupError: return None
+    return _CHARSET_ALIASES.get(encoding, encoding)
+
+def sniff_charset(content, headers):
+    """
+    Кодировка, объявленная страницей, в порядке приоритета: BOM, charset из Content-Type,
+    <meta charset> / http-equiv в первых CHARSET_SNIFF_BYTES байтах. None, если не объявлена.
+    """
+    for bom, encoding in _BOMS:
+        if content.startswith(bom): return encoding
+    match = _HEADER_CHARSET_RE.search(headers.get('Content-Type') or '')
+    if match and normalize_charset(match.group(1)): return normalize_charset(match.group(1))
+    match = _META_CHARSET_RE.search(content[:CHARSET_SNIFF_BYTES])
+    if match: return normalize_charset(match.group(1).decode('ascii', 'ignore'))
+    return None
+
+def decode_html(content, headers):
+    """
+    Декодирует тело ответа из байтов: сначала объявленной кодировкой (sniff_charset), затем UTF-8,
+    и только если оба не подошли - автоопределением. Кракозябры в тексте здесь не исправляются, см. fix_mojibake.
+    """
+    for encoding in (sniff_charset(content, headers), 'utf-8'):
+        if not encoding: continue
+        try: return content.decode(encoding)
+        except UnicodeDecodeError: pass
+    encoding = normalize_charset(requests.compat.chardet.detect(content)['encoding'] or 'utf-8') or 'utf-8'
+    return content.decode(encoding, errors='replace')
+
+_NON_ASCII_RUN_RE = re.compile(r'[^\x00-\x7f]+')
+
+def is_plausible_char(char):
+    """Может ли символ стоять в тексте товара: латиница, греческий, кириллица, пунктуация, валюты, математика."""
+    code = ord(char)
+    if not (code < 0x250 or 0x370 <= code < 0x530 or 0x2000 <= code < 0x2300): return False
+    return unicodedata.category(char) not in ('Mn', 'Cc', 'Cs', 'Co', 'Cn')
+
+def undo_misdecoding(text, encoding):
+    """
+    Обращает чтение UTF-8 в однобайтовой encoding: "ch√™ne" -> "chêne" для mac_roman.
+    Исправляются только последовательности байт, дающие корректный UTF-8 и правдоподобный символ;
+    остальное остаётся как было. Так переживают &nbsp; и другие сущности, раскрытые уже после порчи текста.
+    """
+    def undo_run(match):
+        try: raw = match.group().encode(encoding)
+        except UnicodeEncodeError: return match.group()
+        return ''.join(char if is_plausible_char(char) else char.encode('utf-8', 'surrogateescape').decode(encoding)
+                       for char in raw.decode('utf-8', 'surrogateescape'))
+    return _NON_ASCII_RUN_RE.sub(undo_run, text)
+
+@functools.lru_cache(maxsize=MOJIBAKE_CACHE_SIZE)
+def fix_mojibake(text):
+    """
+    Исправляет кракозябры ("ch√™ne", "chГЄne", "chÃªne") в одном текстовом поле.
+    Сначала пробуются MOJIBAKE_ENCODINGS (выбирается та, что исправила больше всего),
+    затем, если ftfy всё ещё видит следы двойного декодирования, - ftfy.fix_text.
+    ASCII и чистый текст возвращаются без изменений.
+    """
+    if not text or text.isascii(): return text
+    best = text
+    for encoding in MOJIBAKE_ENCODINGS:
+        candidate = undo_misdecoding(text, encoding)
+        if len(candidate) < len(best): best = candidate
+    return ftfy.fix_text(best) if has_mojibake(best) else best
+
+def fetch_page(url_to_fetch, validators=None):
+    """
+    Загружает страницу и декодирует её (decode_html). Возвращает (HTML, заголовки ответа)
+    или (None, None) при ошибке; NotModified (304 по validators) пробрасывается.
+    """
+    try:
+        # print(f"  Загрузка: {url_to_fetch}") 
+        content, response_headers = fetch_raw(url_to_fetch, validators)
+        started = time.perf_counter()
+        html_text = decode_html(content, response_headers)
+        metrics.add_timing('decode', time.perf_counter() - started)
+        return html_text, response_headers
+    except NotModified:
+        raise
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при загрузке страницы {url_to_fetch}: {e}")
-        return None
+        return None, None
     except Exception as e:
-        print(f"Неизвестная ошибка в fetch_page_content для {url_to_fetch}: {e}")
-        return None
+        print(f"Неизвестная ошибка в fetch_page для {url_to_fetch}: {e}")
+        return None, None
+
+def fetch_page_content(url_to_fetch):
+    """Загружает HTML-содержимое страницы и декодирует его (decode_html)."""
+    return fetch_page(url_to_fetch)[0]
+
+_available_backends = {}
+
+def get_parser_backend():
+    """PARSER_BACKEND, если он установлен, иначе встроенный 'html.parser'."""
+    if PARSER_BACKEND not in _available_backends:
+        try:
+            BeautifulSoup('', PARSER_BACKEND)
+            _available_backends[PARSER_BACKEND] = True
+        except FeatureNotFound:
+            print(f"Парсер '{PARSER_BACKEND}' не установлен, используется 'html.parser'.")
+            _available_backends[PARSER_BACKEND] = False
+    return PARSER_BACKEND if _available_backends[PARSER_BACKEND] else 'html.parser'
+
+
+class ProductRegionStrainer(SoupStrainer):
+    """
+    Частичный разбор страницы товара: в дерево попадают только заголовок h1, хлебные крошки,
+    цены, описания, детали и изображения. Меню, скрипты, подвал и похожие товары пропускаются.
+    """
+    @staticmethod
+    def is_product_region(name, attrs):
+        attrs = attrs or {}
+        tag_id = attrs.get('id') or ''
+        classes = attrs.get('class') or ''
+        if isinstance(classes, str): classes = classes.split()
+        if name == 'h1': return True
+        if name == 'nav': return 'breadcrumb' in classes
+        if tag_id == 'product-details': return True
+        if name != 'div': return False
+        return ('product-prices' in classes or 'product-images' in classes or tag_id == 'description'
+                or tag_id.startswith('product-description-short-'))
+
+    def allow_tag_creation(self, nsprefix, name, attrs): # beautifulsoup4 >= 4.13
+        return self.is_product_region(name, attrs)
 
-def strip_all_attributes_from_html_tags(html_string):
+    def search_tag(self, markup_name=None, markup_attrs={}): # beautifulsoup4 < 4.13
+        if isinstance(markup_name, Tag):
+            markup_name, markup_attrs = markup_name.name, markup_name.attrs
+        return markup_name if self.is_product_region(markup_name, dict(markup_attrs)) else None
+
+_product_region_strainer = ProductRegionStrainer()
+
+def strip_attributes_in_place(tag):
     """
-    Удаляет ВСЕ атрибуты (class, id, style и т.д.) из ВСЕХ HTML-тегов в предоставленной строке.
-    Оставляет только "голые" HTML-теги и их текстовое содержимое.
+    Удаляет все атрибуты (class, id, style и т.д.) у tag и всех вложенных тегов прямо в дереве
+    и возвращает HTML tag: остаются только "голые" теги и текст, без повторного разбора строки.
     """
-    if not html_string or not isinstance(html_string, str): return "" 
-    temp_soup = BeautifulSoup(html_string, 'html.parser')
-    for tag in temp_soup.find_all(True): tag.attrs = {} 
-    if temp_soup.body: return temp_soup.body.decode_contents() 
-    elif temp_soup.html: return temp_soup.html.decode_contents() 
-    else: return "".join(str(content) for content in temp_soup.contents)
+    tag.attrs = {}
+    for nested_tag in tag.find_all(True): nested_tag.attrs = {}
+    return str(tag)
 
-def parse_data(html_content, product_url): 
-    """Извлекает все необходимые данные со страницы товара."""
+def parse_data(html_content, product_url, timings=None): 
+    """
+    Извлекает все необходимые данные со страницы товара.
+    Кракозябры исправляются в каждом извлечённом текстовом поле отдельно (fix_mojibake).
+    Если передан словарь timings, в timings['strip'] и timings['mojibake'] записывается время
+    удаления атрибутов и исправления кодировки (сек).
+    """
     if not html_content: return None
-    soup = BeautifulSoup(html_content, 'html.parser') 
+    parse_only = _product_region_strainer if PARSE_PRODUCT_REGIONS_ONLY else None
+    soup = BeautifulSoup(html_content, get_parser_backend(), parse_only=parse_only) 
     data = {
         'url': product_url, 'title': '', 'category': '', 'price': None, 
         'short_description': '', 'full_description_html': '', 
@@ -98,17 +670,12 @@ def parse_data(html_content, product_url):
         except (ValueError, TypeError):
             data['price'] = price_str_to_convert 
 
+    # Области с описаниями только находим: атрибуты удаляются в самом конце, прямо в дереве,
+    # чтобы поиск изображений ниже ещё видел data-image-* атрибуты
     short_desc_container = soup.find('div', id=lambda x: x and x.startswith('product-description-short-'))
-    if short_desc_container: data['short_description'] = strip_all_attributes_from_html_tags(str(short_desc_container))
-    
     full_desc_tab_content = soup.find('div', id='description')
-    if full_desc_tab_content: data['full_description_html'] = strip_all_attributes_from_html_tags(str(full_desc_tab_content))
-
     product_details_section = soup.select_one('#product-details section.product-features')
-    if product_details_section: data['product_details_html'] = strip_all_attributes_from_html_tags(str(product_details_section))
-    else:
-        pd_fallback = soup.find('div', id='product-details')
-        if pd_fallback: data['product_details_html'] = strip_all_attributes_from_html_tags(str(pd_fallback))
+    if not product_details_section: product_details_section = soup.find('div', id='product-details')
 
     images_container = soup.select_one('div.product-images')
     if images_container:
@@ -125,6 +692,16 @@ def parse_data(html_content, product_url):
                         if data['image_url']: break
                     except: pass
         if not data['image_url'] and imgs: data['image_url'] = imgs[0].get('src', '')  
+
+    strip_started = time.perf_counter()
+    if short_desc_container: data['short_description'] = strip_attributes_in_place(short_desc_container)
+    if full_desc_tab_content: data['full_description_html'] = strip_attributes_in_place(full_desc_tab_content)
+    if product_details_section: data['product_details_html'] = strip_attributes_in_place(product_details_section)
+    if timings is not None: timings['strip'] = time.perf_counter() - strip_started
+
+    mojibake_started = time.perf_counter()
+    for field in TEXT_FIELDS: data[field] = fix_mojibake(data[field])
+    if timings is not None: timings['mojibake'] = time.perf_counter() - mojibake_started
     return data
 
 def get_product_links_and_next_page(category_page_html):
@@ -187,9 +764,45 @@ def get_product_links_and_next_page(category_page_html):
     return product_links, next_page_url, category_name_from_h1
 
 
+def get_pagination_page_urls(category_page_html, category_page_url):
+    """
+    URL страниц 2..N категории по блоку пагинации её первой страницы (PrestaShop: параметр ?page=N).
+    Пустой список, если страница одна или схему URL пагинации определить не удалось.
+    """
+    soup = BeautifulSoup(category_page_html, get_parser_backend())
+    page_count, page_link = 1, None
+    for link in soup.select('nav.pagination a[href]'):
+        link_text = link.get_text(strip=True)
+        if link_text.isdigit():
+            page_count = max(page_count, int(link_text))
+            if 'page=' in link['href']: page_link = link['href']
+    if page_count < 2 or page_link is None: return []
+    parsed = urlparse(urljoin(category_page_url, page_link))
+    query = [(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True) if key != 'page']
+    return [urlunparse(parsed._replace(query=urlencode(query + [('page', n)]), fragment=''))
+            for n in range(2, page_count + 1)]
+
+def fetch_category_pages(page_urls):
+    """
+    Параллельно загружает страницы категории. Возвращает пары (url, ссылки на товары) в порядке page_urls;
+    вместо ссылок None, если страницу загрузить не удалось.
+    """
+    def fetch_links(page_url):
+        category_page_html = fetch_page_content(page_url)
+        if not category_page_html:
+            print(f"  Не удалось загрузить страницу категории: {page_url}")
+            return None
+        return get_product_links_and_next_page(category_page_html)[0]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        yield from iter_in_order(executor, fetch_links, page_urls, MAX_CONCURRENT_REQUESTS * 2)
+
 def crawl_category_products(start_category_url):
-    """Собирает все URL товаров со всех страниц указанной категории."""
-    all_product_urls = set() 
+    """
+    Собирает все URL товаров со всех страниц указанной категории (в порядке появления на страницах).
+    Возвращает (URL товаров, имя папки, complete); complete=False, если какая-то страница категории не загрузилась.
+    """
+    all_product_urls = {} # упорядоченное множество
+    complete = True
     current_page_url = start_category_url
     processed_pages = 0
     category_name_for_folder = start_category_url.split('/')[-1] 
@@ -205,6 +818,7 @@ def crawl_category_products(start_category_url):
         category_page_html = fetch_page_content(current_page_url)
         if not category_page_html:
             print(f"  Не удалось загрузить страницу категории: {current_page_url}")
+            complete = False
             break 
         
         product_links_on_page, next_page_url_temp, cat_name_h1 = get_product_links_and_next_page(category_page_html)
@@ -218,17 +832,29 @@ def crawl_category_products(start_category_url):
         if product_links_on_page:
             print(f"    Найдено {len(product_links_on_page)} ссылок на товары.")
             for link in product_links_on_page:
-                all_product_urls.add(link)
+                all_product_urls.setdefault(link)
         else:
             print(f"    Ссылок на товары на странице не найдено.")
 
+        if processed_pages == 1 and PARALLEL_PAGINATION:
+            other_page_urls = get_pagination_page_urls(category_page_html, current_page_url)
+            if other_page_urls:
+                print(f"  Страниц в категории: {len(other_page_urls) + 1}, остальные загружаются параллельно.")
+                for page_url, page_links in fetch_category_pages(other_page_urls):
+                    if page_links is None:
+                        complete = False
+                        continue
+                    print(f"  Страница категории {page_url}: найдено {len(page_links)} ссылок на товары.")
+                    for link in page_links:
+                        all_product_urls.setdefault(link)
+                break
+
         if next_page_url_temp:
             # Проверяем, не является ли ссылка относительной и не начинается ли она с #
             if next_page_url_temp.startswith("http"):
                 current_page_url = next_page_url_temp
             elif next_page_url_temp.startswith("/"):
                 # Собираем абсолютный URL из схемы и хоста стартового URL
-                from urllib.parse import urlparse, urljoin
                 parsed_start_url = urlparse(start_category_url)
                 base_url = f"{parsed_start_url.scheme}://{parsed_start_url.netloc}"
                 current_page_url = urljoin(base_url, next_page_url_temp)
@@ -241,108 +867,779 @@ def crawl_category_products(start_category_url):
 
 
             print(f"    Переход на следующую страницу: {current_page_url}")
-            time.sleep(1) 
         else:
             print(f"  Достигнута последняя страница категории или ссылка на следующую не найдена.")
             current_page_url = None 
 
     print(f"Завершено сканирование категории. Всего найдено уникальных ссылок на товары: {len(all_product_urls)}")
-    return list(all_product_urls), category_name_for_folder
+    if not complete: print(f"  ⚠️ Не все страницы категории загружены: {start_category_url}")
+    return list(all_product_urls), category_name_for_folder, complete
 
 
-def save_to_csv(list_of_products_data, category_folder_name, base_filename="products"):
-    """Сохраняет список данных о товарах в CSV-файл в указанную подпапку."""
-    if not list_of_products_data: 
-        print("Нет данных для сохранения в CSV.")
-        return None
-        
-    if not category_folder_name: 
-        category_folder_name = "default_category_output"
-        print(f"Предупреждение: Имя категории для папки не определено, используется '{category_folder_name}'")
+class SeenUrls:
+    """
+    Компактное множество уже встреченных URL: хранит 64-битные хэши (blake2b) вместо строк.
+    Якорь (#...) не учитывается. Вероятность ложного совпадения на миллионах URL пренебрежимо мала.
+    """
+    def __init__(self):
+        self._hashes = set()
+
+    @staticmethod
+    def _key(url):
+        return int.from_bytes(hashlib.blake2b(urldefrag(url)[0].encode('utf-8'), digest_size=8).digest(), 'big')
 
-    if not os.path.exists(category_folder_name):
+    def add(self, url):
+        """Добавляет url; возвращает False, если он уже встречался."""
+        key = self._key(url)
+        if key in self._hashes: return False
+        self._hashes.add(key)
+        return True
+
+    def __contains__(self, url):
+        return self._key(url) in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+
+def iter_sitemap_urls(sitemap_url, failed=None):
+    """
+    URL страниц из sitemap.xml (в том числе .xml.gz); индекс sitemap обходится рекурсивно.
+    URL sitemap, которые не удалось загрузить или разобрать, добавляются в список failed.
+    """
+    try:
+        content, _ = fetch_raw(sitemap_url)
+        if content[:2] == b'\x1f\x8b': content = gzip.decompress(content)
+        root = ElementTree.fromstring(content)
+    except (requests.exceptions.RequestException, OSError, ElementTree.ParseError) as e:
+        print(f"Ошибка при загрузке sitemap {sitemap_url}: {e}")
+        if failed is not None: failed.append(sitemap_url)
+        return
+    locations = [loc.text.strip() for loc in root.findall('.//{*}loc') if loc.text]
+    if root.tag.endswith('sitemapindex'):
+        for nested_sitemap_url in locations:
+            yield from iter_sitemap_urls(nested_sitemap_url, failed)
+    else:
+        yield from locations
+
+class CrawlCheckpoint:
+    """
+    Контрольная точка обхода в JSON-файле: какие категории/sitemap уже пройдены, собранные URL
+    товаров, имя папки и путь к файлу вывода. Какие товары уже записаны и до какого места,
+    хранит файл .progress рядом с выводом (см. ProductWriter), поэтому здесь при обработке
+    товаров ничего не переписывается. Файл записывается атомарно (через временный + os.replace).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+
+    def load(self):
         try:
-            os.makedirs(category_folder_name)
-            print(f"Создана подпапка: ./{category_folder_name}/")
-        except OSError as e:
-            print(f"Ошибка при создании подпапки ./{category_folder_name}/: {e}")
-            return None 
-    
+            with open(self.path, encoding='utf-8') as f:
+                self.data = json.load(f)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def save(self, **updates):
+        self.data.update(updates)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        self.data = {}
+        if os.path.exists(self.path): os.remove(self.path)
+
+
+def build_crawl_frontier(category_urls, sitemap_url=None, checkpoint=None):
+    """
+    Собирает URL товаров со всех категорий и из sitemap без повторов.
+    После каждого источника состояние сохраняется в checkpoint; уже пройденные источники
+    из checkpoint повторно не сканируются.
+    Возвращает (список URL товаров, имя папки для вывода, complete); complete=False, если какая-то
+    страница категории или sitemap не загрузилась и список товаров может быть неполным.
+    """
+    saved = checkpoint.data if checkpoint else {}
+    sources_done = list(saved.get('sources_done', []))
+    incomplete_sources = list(saved.get('incomplete_sources', []))
+    product_urls = list(saved.get('product_urls', []))
+    folder_name = saved.get('category_folder_name')
+    seen = SeenUrls()
+    for url in product_urls: seen.add(url)
+    if sources_done:
+        print(f"Из контрольной точки: пройдено источников {len(sources_done)}, товаров {len(product_urls)}")
+
+    def add_urls(urls):
+        added = [url for url in urls if seen.add(url)]
+        product_urls.extend(added)
+        return len(added)
+
+    def source_done(source, complete):
+        sources_done.append(source)
+        if not complete: incomplete_sources.append(source)
+        if checkpoint: checkpoint.save(sources_done=sources_done, incomplete_sources=incomplete_sources,
+                                       product_urls=product_urls, category_folder_name=folder_name)
+
+    for category_url in category_urls:
+        if category_url in sources_done: continue
+        category_product_urls, folder_name, complete = crawl_category_products(category_url)
+        added = add_urls(category_product_urls)
+        print(f"  Новых товаров из категории: {added} (повторов: {len(category_product_urls) - added})")
+        source_done(category_url, complete)
+    if sitemap_url and sitemap_url not in sources_done:
+        print(f"Поиск товаров в sitemap: {sitemap_url}")
+        pattern = re.compile(SITEMAP_PRODUCT_URL_PATTERN)
+        failed_sitemaps = []
+        added = add_urls(url for url in iter_sitemap_urls(sitemap_url, failed_sitemaps) if pattern.search(url))
+        print(f"  Новых товаров из sitemap: {added}")
+        source_done(sitemap_url, not failed_sitemaps)
+    if len(category_urls) != 1 or sitemap_url:
+        folder_name = MULTI_SOURCE_FOLDER_NAME
+    if checkpoint: checkpoint.save(category_folder_name=folder_name, frontier_complete=True)
+    print(f"Всего уникальных товаров для обработки: {len(product_urls)}")
+    if incomplete_sources: print(f"⚠️ Загружены не полностью: {', '.join(incomplete_sources)}")
+    return product_urls, folder_name, not incomplete_sources
+
+
+def replace_double_quotes(product_data_dict):
+    """Заменяет двойные кавычки на одинарные во всех строковых значениях (для CSV вывода)."""
+    return {key: value.replace('"', "'") if isinstance(value, str) else value
+            for key, value in product_data_dict.items()}
+
+
+class ProductWriter:
+    """
+    Потоковая запись товаров по одному: CSV или JSON Lines, без сжатия, gzip или zstd.
+    Каждые OUTPUT_FLUSH_EVERY записей данные сбрасываются на диск; сжатый поток при этом
+    закрывает очередной gzip-member / zstd-frame, так что файл до этой точки всегда читается целиком.
+    Рядом ведётся файл <имя>.progress: URL сброшенных записей и строка "#<смещение>" после каждого
+    сброса. По нему незавершённый файл можно продолжить (resume=True): хвост после последнего
+    сброса отрезается, уже записанные URL доступны в written_urls. При успешном завершении
+    (close(finished=True)) файл .progress удаляется; существующий файл без .progress считается
+    завершённым, и resume=True для него вызывает FileExistsError.
+    before_commit вызывается в flush() перед записью отметки: то, что должно сохраниться вместе
+    с записанными товарами (состояние инкрементального режима), сохраняется в нём.
+    autoflush=False: сброс только явным flush(), без счётчика OUTPUT_FLUSH_EVERY.
+    """
+    def __init__(self, path, output_format='csv', compression=None, resume=False, fieldnames=PRODUCT_FIELDNAMES, autoflush=True):
+        self.path = path
+        self.output_format = output_format
+        self.compression = compression
+        self.fieldnames = fieldnames
+        self.autoflush = autoflush
+        self.before_commit = None
+        self.progress_path = path + '.progress'
+        self.written_urls = set()
+        offset = 0
+        if resume and os.path.exists(path) and not os.path.exists(self.progress_path):
+            # Без .progress файл уже завершён: открыть его на запись значило бы стереть готовый вывод
+            raise FileExistsError(f"{path} уже завершён (нет {self.progress_path}), продолжать нечего")
+        if resume and os.path.exists(path) and os.path.exists(self.progress_path):
+            offset, self.written_urls, progress_size = self._read_progress()
+            os.truncate(path, offset)
+            os.truncate(self.progress_path, progress_size) # URL после последней отметки в вывод не попали
+        else:
+            open(self.progress_path, 'w').close()
+        self.records_written = len(self.written_urls)
+        self._raw = open(path, 'r+b' if offset else 'wb')
+        self._raw.seek(offset)
+        self._progress = open(self.progress_path, 'a', encoding='utf-8', newline='\n') # смещения в _read_progress считаются в байтах
+        self._stream = None # открывается лениво: каждый сброс начинает новый member/frame
+        self._unflushed_urls = []
+        self._text = io.StringIO()
+        self._csv = csv.DictWriter(self._text, fieldnames=fieldnames, extrasaction='ignore')
+        if offset == 0 and output_format == 'csv':
+            self._text.write('\ufeff') # BOM, чтобы Excel открывал CSV в UTF-8
+            self._csv.writeheader()
+            self._write_text()
+
+    def _read_progress(self):
+        """Последнее подтверждённое смещение, URL, записанные до него, и длина .progress до этой отметки."""
+        offset, committed, pending, progress_size, position = 0, set(), [], 0, 0
+        with open(self.progress_path, 'rb') as f:
+            for raw_line in f:
+                if not raw_line.endswith(b'\n'): break # строка оборвалась при аварийном завершении
+                position += len(raw_line)
+                line = raw_line[:-1].decode('utf-8').rstrip('\r')
+                if line.startswith('#'):
+                    offset, progress_size = int(line[1:]), position
+                    committed.update(pending)
+                    pending = []
+                else:
+                    pending.append(line)
+        return offset, committed, progress_size
+
+    def _open_stream(self):
+        if self.compression == 'gzip':
+            return gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=6)
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=3).stream_writer(self._raw, closefd=False)
+        return self._raw
+
+    def _write_text(self):
+        if self._stream is None: self._stream = self._open_stream()
+        self._stream.write(self._text.getvalue().encode('utf-8'))
+        self._text.seek(0)
+        self._text.truncate()
+
+    def write(self, product_data):
+        if self.output_format == 'jsonl':
+            self._text.write(json.dumps(product_data, ensure_ascii=False) + '\n')
+        else:
+            self._csv.writerow(replace_double_quotes(product_data))
+        self._write_text()
+        self.written_urls.add(product_data.get('url', ''))
+        self._unflushed_urls.append(product_data.get('url', ''))
+        self.records_written += 1
+        if self.autoflush and len(self._unflushed_urls) >= OUTPUT_FLUSH_EVERY: self.flush()
+
+    def flush(self):
+        """Сбрасывает записанное на диск и отмечает точку, с которой можно продолжить."""
+        if self._stream is not None and self._stream is not self._raw:
+            self._stream.close() # завершает gzip-member / zstd-frame, сам файл остаётся открытым
+            self._stream = None
+        self._raw.flush()
+        if self.before_commit: self.before_commit()
+        self._progress.write(''.join(url + '\n' for url in self._unflushed_urls) + f"#{self._raw.tell()}\n")
+        self._progress.flush()
+        self._unflushed_urls = []
+
+    def close(self, finished=True):
+        self.flush()
+        self._raw.close()
+        self._progress.close()
+        if finished: os.remove(self.progress_path)
+
+
+def output_fieldnames():
+    """Колонки CSV вывода: PRODUCT_FIELDNAMES и image_path, если изображения скачиваются."""
+    return PRODUCT_FIELDNAMES + (IMAGE_FIELDNAMES if DOWNLOAD_IMAGES else [])
+
+def open_product_writer(category_folder_name, base_filename):
+    """
+    Открывает ProductWriter в папке категории. При OUTPUT_RESUME продолжает незавершённый
+    файл прошлого запуска с тем же форматом, иначе создаёт новый файл с временной меткой.
+    """
+    compression = OUTPUT_COMPRESSION
+    if compression == 'zstd' and zstandard is None:
+        print("Модуль zstandard не установлен, используется сжатие gzip.")
+        compression = 'gzip'
+    extension = OUTPUT_FORMAT + {'gzip': '.gz', 'zstd': '.zst'}.get(compression, '')
+    os.makedirs(category_folder_name, exist_ok=True)
+    filename_base_part = re.sub(r'[^\w-]', '', category_folder_name)
+    prefix = os.path.join(category_folder_name, f"{filename_base_part}_{base_filename}_")
+    if OUTPUT_RESUME:
+        unfinished = sorted(path[:-len('.progress')] for path in glob.glob(glob.escape(prefix) + '*.progress'))
+        # только файлы вида <prefix><время>.<расширение>: файл изменений (<prefix>delta_...) сюда не попадает
+        own_name = re.compile(re.escape(prefix) + r'\d{8}_\d{6}\.' + re.escape(extension))
+        unfinished = [path for path in unfinished if own_name.fullmatch(path) and os.path.exists(path)]
+        if unfinished:
+            return ProductWriter(unfinished[-1], OUTPUT_FORMAT, compression, resume=True, fieldnames=output_fieldnames())
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename_base_part = re.sub(r'[^\w-]', '', category_folder_name) 
-    csv_filename = os.path.join(category_folder_name, f"{filename_base_part}_{base_filename}_{timestamp}.csv")
-
-    processed_data_list = []
-    for product_data_dict in list_of_products_data:
-        processed_item = {}
-        for key, value in product_data_dict.items():
-            if isinstance(value, str):
-                temp_value = value.replace('"', "'")
-                processed_item[key] = temp_value
-            else:
-                processed_item[key] = value 
-        processed_data_list.append(processed_item)
+    return ProductWriter(f"{prefix}{timestamp}.{extension}", OUTPUT_FORMAT, compression, fieldnames=output_fieldnames())
+
+def delta_path_for(output_path):
+    """
+    Файл изменений в пару к файлу вывода: <prefix><время>.<расширение> -> <prefix>delta_<время>.csv.
+    Продолжается вместе с выводом, как бы тот ни был найден (--resume или OUTPUT_RESUME).
+    """
+    folder, name = os.path.split(output_path)
+    prefix, timestamp = re.fullmatch(r'(.*_)(\d{8}_\d{6})\..*', name).groups()
+    return os.path.join(folder, f"{prefix}delta_{timestamp}.csv")
+
+class DeltaWriter:
+    """
+    Файл изменений инкрементального режима: CSV с колонкой change, строки пишутся через ProductWriter
+    сразу по мере обнаружения изменений и в памяти не копятся. Файл создаётся при первом изменении;
+    если он уже есть (прерванный запуск), дописывается, а counts (число строк по типу изменения)
+    продолжают счёт по уже записанным строкам.
+    На диск строки сбрасываются только через flush() - вместе с основным выводом и состоянием.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.counts = Counter()
+        self._writer = None
+        if os.path.exists(path):
+            self._open(resume=True)
+            with open(path, encoding='utf-8-sig', newline='') as f:
+                self.counts.update(row['change'] for row in csv.DictReader(f))
+
+    def _open(self, resume=False):
+        self._writer = ProductWriter(self.path, 'csv', resume=resume,
+                                     fieldnames=['change'] + output_fieldnames(), autoflush=False)
+
+    def write(self, product_data, change):
+        if self._writer is None: self._open()
+        self._writer.write(dict(product_data, change=change))
+        self.counts[change] += 1
+
+    def flush(self):
+        if self._writer: self._writer.flush()
+
+    def close(self, finished=False):
+        if self._writer:
+            self._writer.close(finished=finished)
+            if finished: print(f"Изменения ({sum(self.counts.values())} строк) сохранены в файл: {self.path}")
+
+def print_product_preview(first_item):
+    """Отладочный вывод первого записанного товара."""
+    print("\n--- Пример данных первого товара ---")
+    print(f"URL: {first_item.get('url', 'N/A')}")
+    print(f"Title: {first_item.get('title', 'N/A')}")
+    print(f"Category: {first_item.get('category', 'N/A')}")
+    print(f"Price: {first_item.get('price', 'N/A')}")
+    print(f"Image URL: {first_item.get('image_url', 'N/A')}")
+    print(f"Short Description (очищенный HTML, начало):\n{str(first_item.get('short_description', 'N/A'))[:100]}...")
+    print(f"Full Description (очищенный HTML, начало):\n{str(first_item.get('full_description_html', 'N/A'))[:100]}...")
+    print(f"Product Details (очищенный HTML, начало):\n{str(first_item.get('product_details_html', 'N/A'))[:100]}...\n")
+
+def page_fingerprint(html_text):
+    """
+    Хэш содержимого страницы для инкрементального пересканирования. Блоки <script> и поля
+    token не учитываются: в них PrestaShop при каждой загрузке отдаёт новые токены.
+    """
+    stable_html = re.sub(r'<script\b.*?</script>', '', html_text, flags=re.S | re.I)
+    stable_html = re.sub(r'<input[^>]*name="token"[^>]*>', '', stable_html, flags=re.I)
+    return hashlib.sha256(stable_html.encode('utf-8')).hexdigest()
+
+def parser_fingerprint():
+    """Хэш исходного кода функций разбора: после правки селекторов все страницы разбираются заново."""
+    source = ''.join(inspect.getsource(func) for func in (parse_data, strip_attributes_in_place, ProductRegionStrainer, fix_mojibake, undo_misdecoding, is_plausible_char))
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
+
+class ScrapeState:
+    """
+    Состояние между запусками (SQLite в папке категории): для каждого URL товара - хэш
+    страницы, ETag/Last-Modified ответа и последний разобранный словарь данных. Используется
+    только из основного потока; known_hashes и known_validators можно читать из рабочих потоков.
+    """
+    def __init__(self, category_folder_name):
+        os.makedirs(category_folder_name, exist_ok=True)
+        self.db_path = os.path.join(category_folder_name, STATE_DB_FILENAME)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS products (
+            url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, parser TEXT NOT NULL,
+            record TEXT NOT NULL, updated_at TEXT NOT NULL, etag TEXT, last_modified TEXT)""")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(products)")}
+        for column in ('etag', 'last_modified'): # база из версии без условных запросов
+            if column not in columns: self.conn.execute(f"ALTER TABLE products ADD COLUMN {column} TEXT")
+        self.parser = parser_fingerprint()
+        self.known_hashes = dict(self.conn.execute(
+            "SELECT url, content_hash FROM products WHERE parser = ?", (self.parser,)))
+        # Только для записей текущего парсера: на 304 переиспользуется сохранённый разбор
+        self.known_validators = {url: {'ETag': etag, 'Last-Modified': last_modified}
+                                 for url, etag, last_modified in self.conn.execute(
+                                     "SELECT url, etag, last_modified FROM products WHERE parser = ? "
+                                     "AND (etag IS NOT NULL OR last_modified IS NOT NULL)", (self.parser,))}
+        self.unchanged_count = 0
+
+    def load_record(self, url):
+        row = self.conn.execute("SELECT record FROM products WHERE url = ?", (url,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, url, page_hash, product_data, validators=None):
+        """Сохраняет свежий разбор страницы. Возвращает 'added', 'changed' или None (данные те же)."""
+        record_json = json.dumps(product_data, ensure_ascii=False, sort_keys=True)
+        row = self.conn.execute("SELECT record FROM products WHERE url = ?", (url,)).fetchone()
+        validators = validators or {}
+        self.conn.execute("INSERT OR REPLACE INTO products (url, content_hash, parser, record, updated_at, etag, last_modified) "
+                          "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (url, page_hash, self.parser, record_json, datetime.now().isoformat(timespec='seconds'),
+                           validators.get('ETag'), validators.get('Last-Modified')))
+        if row is None: return 'added'
+        return 'changed' if row[0] != record_json else None
+
+    def update_validators(self, url, validators):
+        """Запоминает ETag/Last-Modified страницы, которая загрузилась целиком, но не изменилась."""
+        validators = validators or {}
+        self.conn.execute("UPDATE products SET etag = ?, last_modified = ? WHERE url = ?",
+                          (validators.get('ETag'), validators.get('Last-Modified'), url))
+
+    def remove_missing(self, seen_urls):
+        """Удаляет товары, которых больше нет в категории. Возвращает их последние данные."""
+        seen_urls = set(seen_urls)
+        removed = [(url, json.loads(record)) for url, record in self.conn.execute("SELECT url, record FROM products")
+                   if url not in seen_urls]
+        self.conn.executemany("DELETE FROM products WHERE url = ?", [(url,) for url, _ in removed])
+        return [record for _, record in removed]
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class ImageStore:
+    """
+    Изображения товаров в папке images_dir. Тело ответа пишется на диск блоками (iter_content),
+    без буферизации целиком в памяти. Повторы отсекаются дважды: каждый URL скачивается не больше
+    одного раза за запуск (даже если его одновременно запросили несколько потоков), а файлы
+    именуются по sha256 содержимого, так что одинаковые изображения с разных URL хранятся один раз.
+    Индекс IMAGE_INDEX_FILENAME помнит для URL файл и ETag/Last-Modified: в следующих запусках
+    изображение перепроверяется условным запросом и на 304 не скачивается.
+    """
+    def __init__(self, images_dir):
+        self.images_dir = images_dir
+        self.index_path = os.path.join(images_dir, IMAGE_INDEX_FILENAME)
+        os.makedirs(images_dir, exist_ok=True)
+        try:
+            with open(self.index_path, encoding='utf-8') as f: self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+        self._lock = threading.Lock()
+        self._claims = {} # URL -> Event, установленный после его загрузки в этом запуске
+        self._paths = {}  # URL -> итоговый путь в этом запуске
 
-    fieldnames = ['url', 'title', 'category', 'price', 
-                  'short_description', 'full_description_html', 'product_details_html',
-                  'image_url']
+    def download(self, url):
+        """Локальный путь изображения url ('' для пустого url или при ошибке загрузки)."""
+        if not url: return ''
+        with self._lock:
+            claim = self._claims.get(url)
+            if claim is None: self._claims[url] = threading.Event()
+        if claim is not None: # этот URL уже скачивает (или скачал) другой поток
+            claim.wait()
+            return self._paths[url]
+        path = ''
+        try:
+            path = self._fetch(url)
+        except (requests.exceptions.RequestException, OSError) as e:
+            print(f"Ошибка при загрузке изображения {url}: {e}")
+        finally:
+            self._paths[url] = path
+            self._claims[url].set()
+        return path
+
+    def _fetch(self, url):
+        entry = self._index.get(url)
+        if entry and not os.path.exists(os.path.join(self.images_dir, entry['file'])): entry = None
+        if HTTP_CACHE_MODE == 'replay': # без сети: только то, что уже скачано
+            return os.path.join(self.images_dir, entry['file']) if entry else ''
+        started = time.perf_counter()
+        with http_get(url, headers=conditional_headers(entry) if entry else None, stream=True) as response:
+            if entry and response.status_code == 304:
+                metrics.count('images_not_modified')
+                return os.path.join(self.images_dir, entry['file'])
+            response.raise_for_status()
+            digest, size = hashlib.sha256(), 0
+            with tempfile.NamedTemporaryFile(dir=self.images_dir, suffix='.part', delete=False) as f:
+                try:
+                    for chunk in response.iter_content(IMAGE_CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                except BaseException:
+                    f.close()
+                    os.remove(f.name)
+                    raise
+            headers = response.headers
+        metrics.add_timing('image', time.perf_counter() - started)
+        metrics.count('image_bytes', size)
+        metrics.count('bytes_downloaded', wire_size(response, size))
+        filename = digest.hexdigest()[:32] + self._extension(url, headers.get('Content-Type'))
+        final_path = os.path.join(self.images_dir, filename)
+        if os.path.exists(final_path): # то же содержимое уже скачано с другого URL или в прошлый раз
+            os.remove(f.name)
+            metrics.count('images_duplicate')
+        else:
+            os.replace(f.name, final_path)
+            metrics.count('images_downloaded')
+        with self._lock:
+            self._index[url] = {'file': filename, 'ETag': headers.get('ETag'), 'Last-Modified': headers.get('Last-Modified')}
+        return final_path
+
+    @staticmethod
+    def _extension(url, content_type):
+        extension = os.path.splitext(urlparse(url).path)[1].lower()
+        if extension in ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.avif', '.svg'): return extension
+        return mimetypes.guess_extension((content_type or '').split(';')[0].strip()) or '.img'
+
+    def save_index(self):
+        """Записывает индекс атомарно (через временный файл + os.replace)."""
+        with self._lock:
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+
+
+ProductResult = namedtuple('ProductResult', 'data page_hash unchanged timings validators')
+FetchedPage = namedtuple('FetchedPage', 'url html page_hash unchanged validators')
+
+def fetch_product_page(product_url, known_hashes=None, known_validators=None):
+    """
+    Загружает страницу товара (без разбора). HTML не возвращается (unchanged=True), если сервер
+    ответил 304 на условный запрос по known_validators[product_url] или хэш страницы совпал
+    с known_hashes[product_url]. validators - ETag/Last-Modified ответа для ScrapeState.
+    """
     try:
-        with open(csv_filename, 'w', encoding='utf-8-sig', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore') 
-            writer.writeheader() 
-            writer.writerows(processed_data_list) 
-        print(f"Данные ({len(processed_data_list)} товаров) сохранены в файл: {csv_filename}")
-        return csv_filename
-    except IOError as e:
-        print(f"Ошибка при записи в CSV файл {csv_filename}: {e}")
-        return None
+        product_html, headers = fetch_page(product_url, known_validators.get(product_url) if known_validators else None)
+    except NotModified:
+        return FetchedPage(product_url, None, known_hashes.get(product_url), True, None)
+    if not product_html:
+        print(f"    Не удалось загрузить страницу товара: {product_url}")
+        return FetchedPage(product_url, None, None, False, None)
+    validators = response_validators(headers)
+    page_hash = page_fingerprint(product_html) if known_hashes is not None else None
+    if page_hash and known_hashes.get(product_url) == page_hash:
+        return FetchedPage(product_url, None, page_hash, True, validators)
+    return FetchedPage(product_url, product_html, page_hash, False, validators)
 
-def main():
-    """Основная функция для запуска скрапера."""
-    print(f"Парсинг URL категории: {START_CATEGORY_URL}")
-    
-    product_urls_to_parse, category_folder_name = crawl_category_products(START_CATEGORY_URL)
+_parse_profiler = None
+_parse_profiler_lock = threading.Lock()
+
+def profiled_parse_data(html_content, product_url, timings):
+    """parse_data под cProfile (PROFILE_PARSE_PATH). Вызовы идут по одному: профайлер не рассчитан на потоки."""
+    global _parse_profiler
+    with _parse_profiler_lock:
+        if _parse_profiler is None: _parse_profiler = cProfile.Profile()
+        _parse_profiler.enable()
+        try:
+            return parse_data(html_content, product_url, timings)
+        finally:
+            _parse_profiler.disable()
+
+def save_parse_profile(path):
+    """Сохраняет накопленную статистику cProfile по parse_data и печатает самые дорогие функции."""
+    if _parse_profiler is None: return
+    _parse_profiler.dump_stats(path)
+    print(f"\nПрофиль parse_data сохранён в {path} (просмотр: python -m pstats {path}). Самые дорогие функции:")
+    pstats.Stats(_parse_profiler).sort_stats('cumulative').print_stats(15)
+
+def parse_product_page(page):
+    """
+    Разбирает загруженную страницу товара. Выполняется и в потоках загрузки, и в процессах конвейера,
+    поэтому замеры (parse, strip) возвращаются в ProductResult.timings, а не пишутся в metrics.
+    """
+    if not page.html:
+        return ProductResult(None, page.page_hash, page.unchanged, {}, page.validators)
+    timings = {}
+    started = time.perf_counter()
+    if PROFILE_PARSE_PATH:
+        product_data = profiled_parse_data(page.html, page.url, timings)
+    else:
+        product_data = parse_data(page.html, page.url, timings)
+    timings['parse'] = time.perf_counter() - started
+    if not product_data:
+        print(f"    Не удалось извлечь данные для товара: {page.url}")
+    return ProductResult(product_data, page.page_hash, False, timings, page.validators)
+
+def fetch_and_parse_product(product_url, known_hashes=None, known_validators=None):
+    """Загружает и сразу разбирает одну страницу товара (parse_data пропускается для неизменившихся страниц)."""
+    return parse_product_page(fetch_product_page(product_url, known_hashes, known_validators))
+
+def init_parse_worker(parser_backend, product_regions_only):
+    """Переносит настройки разбора в процесс конвейера (при запуске через spawn модуль импортируется заново)."""
+    global PARSER_BACKEND, PARSE_PRODUCT_REGIONS_ONLY
+    PARSER_BACKEND, PARSE_PRODUCT_REGIONS_ONLY = parser_backend, product_regions_only
+
+def iter_in_order(executor, func, items, window):
+    """
+    Аналог executor.map, но держит в работе не более `window` задач одновременно.
+    Результаты отдаются в исходном порядке items по мере готовности.
+    """
+    items = iter(items)
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= window: break
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+        next_item = next(items, None)
+        if next_item is not None:
+            pending.append((next_item, executor.submit(func, next_item)))
+
+def iter_products(product_urls, known_hashes=None, known_validators=None):
+    """
+    Загружает и разбирает товары, возвращая пары (url, ProductResult) в порядке product_urls.
+    При CONCURRENT_FETCH страницы грузятся в MAX_CONCURRENT_REQUESTS потоков, каждая разбирается
+    сразу после получения; частоту запросов ограничивает wait_for_rate_limit.
+    При PARSE_IN_PROCESS_POOL см. iter_products_pipeline.
+    """
+    if PARSE_IN_PROCESS_POOL and PROFILE_PARSE_PATH:
+        print("Профилирование parse_data работает в одном процессе: пул процессов разбора отключён.")
+    elif PARSE_IN_PROCESS_POOL:
+        yield from iter_products_pipeline(product_urls, known_hashes, known_validators)
+        return
+    if not CONCURRENT_FETCH or MAX_CONCURRENT_REQUESTS <= 1:
+        for product_url in product_urls:
+            yield product_url, fetch_and_parse_product(product_url, known_hashes, known_validators)
+        return
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        # Окно с запасом, чтобы один медленный ответ не останавливал остальные потоки
+        yield from iter_in_order(executor, lambda url: fetch_and_parse_product(url, known_hashes, known_validators),
+                                 product_urls, MAX_CONCURRENT_REQUESTS * 4)
+
+def iter_products_pipeline(product_urls, known_hashes=None, known_validators=None):
+    """
+    Конвейер: потоки только загружают страницы, parse_data выполняется в PARSE_WORKERS процессах.
+    Обе очереди ограничены (окна iter_in_order), поэтому в памяти одновременно не больше
+    MAX_CONCURRENT_REQUESTS * 4 + PARSE_QUEUE_SIZE страниц. Порядок результатов - как в product_urls.
+    Процессы разбора запускаются через forkserver (spawn, где его нет), а не fork: к первой задаче
+    разбора потоки загрузки уже работают, и fork многопоточного процесса может оставить дочерний
+    процесс с чужой захваченной блокировкой (например, stdout).
+    """
+    fetch_workers = MAX_CONCURRENT_REQUESTS if CONCURRENT_FETCH else 1
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_executor, \
+         ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context(start_method),
+                             initializer=init_parse_worker,
+                             initargs=(PARSER_BACKEND, PARSE_PRODUCT_REGIONS_ONLY)) as parse_executor:
+        fetched_pages = iter_in_order(fetch_executor, lambda url: fetch_product_page(url, known_hashes, known_validators),
+                                      product_urls, fetch_workers * 4)
+        pages = (page for _, page in fetched_pages)
+        for page, result in iter_in_order(parse_executor, parse_product_page, pages, PARSE_QUEUE_SIZE):
+            yield page.url, result
+
+def iter_with_stored_records(products, state):
+    """Для неизменившихся страниц подставляет в result.data последний сохранённый разбор из state."""
+    for product_url, result in products:
+        if result.unchanged: result = result._replace(data=state.load_record(product_url))
+        yield product_url, result
+
+def iter_with_images(products, image_store):
+    """
+    Стадия изображений: для товаров (и неизменившихся тоже - изображение могло смениться или пропасть)
+    скачивает image_url в image_store (не более MAX_CONCURRENT_IMAGE_DOWNLOADS одновременно) и дописывает
+    в запись image_path. Относительный image_url разрешается от URL товара. Порядок сохраняется.
+    """
+    def attach_image(item):
+        product_url, result = item
+        if result.data:
+            image_url = result.data.get('image_url')
+            result.data['image_path'] = image_store.download(urljoin(product_url, image_url) if image_url else '')
+        return result
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_IMAGE_DOWNLOADS) as executor:
+        for (product_url, _), result in iter_in_order(executor, attach_image, products, MAX_CONCURRENT_IMAGE_DOWNLOADS * 2):
+            yield product_url, result
+
+def main(resume=False):
+    """
+    Основная функция для запуска скрапера.
+    resume=True продолжает прерванный запуск по контрольной точке CHECKPOINT_FILE: пройденные
+    категории не сканируются заново, уже записанные товары не загружаются.
+    """
+    print(f"Парсинг URL категорий: {', '.join(CATEGORY_URLS)}{f' и sitemap {SITEMAP_URL}' if SITEMAP_URL else ''}")
+    metrics.reset()
+
+    checkpoint = CrawlCheckpoint(CHECKPOINT_FILE)
+    sources = CATEGORY_URLS + ([SITEMAP_URL] if SITEMAP_URL else [])
+    if resume and checkpoint.load() and checkpoint.data.get('sources') == sources:
+        print(f"Продолжение по контрольной точке {CHECKPOINT_FILE}")
+    else:
+        if resume: print(f"Подходящей контрольной точки {CHECKPOINT_FILE} нет, запуск с начала.")
+        checkpoint.remove()
+        checkpoint.save(sources=sources)
+
+    if checkpoint.data.get('frontier_complete'):
+        product_urls_to_parse, category_folder_name = checkpoint.data['product_urls'], checkpoint.data['category_folder_name']
+        frontier_complete = not checkpoint.data.get('incomplete_sources')
+        print(f"Список товаров из контрольной точки: {len(product_urls_to_parse)}")
+    else:
+        product_urls_to_parse, category_folder_name, frontier_complete = build_crawl_frontier(CATEGORY_URLS, SITEMAP_URL, checkpoint)
     
     if not product_urls_to_parse:
         print("Не найдено URL товаров для обработки. Завершение работы.")
+        checkpoint.remove()
         return
 
-    all_products_data = []
-    total_products = len(product_urls_to_parse)
+    state = ScrapeState(category_folder_name) if INCREMENTAL_SCRAPE else None
+    image_store = ImageStore(os.path.join(category_folder_name, IMAGES_DIR)) if DOWNLOAD_IMAGES else None
+    output_path = checkpoint.data.get('output_path')
+    if resume and output_path and os.path.exists(output_path) and not os.path.exists(output_path + '.progress'):
+        print(f"{output_path} уже записан полностью, вывод пойдёт в новый файл.")
+        output_path = None
+    if resume and output_path and os.path.exists(output_path):
+        writer = ProductWriter(output_path, checkpoint.data['output_format'], checkpoint.data['output_compression'],
+                               resume=True, fieldnames=output_fieldnames())
+    else:
+        writer = open_product_writer(category_folder_name, category_folder_name)
+        checkpoint.save(output_path=writer.path, output_format=writer.output_format, output_compression=writer.compression)
+    delta = DeltaWriter(delta_path_for(writer.path)) if state else None
+    if state:
+        def commit_state():
+            # До отметки в .progress: товары, которые --resume пропустит, уже есть в состоянии.
+            # Файл изменений сбрасывается раньше состояния: при сбое между ними строка повторится, но не потеряется
+            delta.flush()
+            state.commit()
+        writer.before_commit = commit_state
+    if writer.written_urls:
+        print(f"\nПродолжение незавершённого запуска: {len(writer.written_urls)} товаров уже записано в {writer.path}")
+    urls_to_process = [url for url in product_urls_to_parse if url not in writer.written_urls]
+    total_products = len(urls_to_process)
     print(f"\nНачало парсинга {total_products} товаров из категории '{category_folder_name}'...")
 
-    for i, product_url in enumerate(product_urls_to_parse):
-        print(f"  Обработка товара {i+1}/{total_products}: {product_url}")
-        product_html = fetch_page_content(product_url)
-        if product_html:
-            product_data = parse_data(product_html, product_url) 
+    finished = False
+    try:
+        products = iter_products(urls_to_process, state.known_hashes if state else None,
+                                 state.known_validators if state else None)
+        if state: products = iter_with_stored_records(products, state)
+        if image_store: products = iter_with_images(products, image_store)
+        for i, (product_url, result) in enumerate(products):
+            print(f"  Обработан товар {i+1}/{total_products}{' (без изменений)' if result.unchanged else ''}: {product_url}")
+            metrics.count('products')
+            metrics.add_timings(result.timings)
+            product_data = result.data
+            if state and result.unchanged:
+                if result.validators: state.update_validators(product_url, result.validators)
+                state.unchanged_count += 1
+                metrics.count('unchanged')
+            elif state and product_data:
+                change = state.update(product_url, result.page_hash, product_data, result.validators)
+                if change: delta.write(product_data, change)
             if product_data:
-                all_products_data.append(product_data)
-            else:
-                print(f"    Не удалось извлечь данные для товара: {product_url}")
+                if writer.records_written == 0: print_product_preview(product_data)
+                write_started = time.perf_counter()
+                writer.write(product_data)
+                metrics.add_timing('write', time.perf_counter() - write_started)
+        finished = True
+    finally:
+        # При сбое незавершённый файл остаётся вместе с .progress и будет продолжен при следующем запуске.
+        # После успеха контрольная точка удаляется раньше .progress: иначе сбой между ними привёл бы
+        # --resume к уже завершённому файлу
+        if finished: checkpoint.remove()
+        writer.close(finished=finished)
+        if image_store: image_store.save_index()
+        if state and not finished:
+            delta.close()
+            state.close()
+
+    if state:
+        if frontier_complete:
+            for record in state.remove_missing(product_urls_to_parse): delta.write(record, 'removed')
         else:
-            print(f"    Не удалось загрузить страницу товара: {product_url}")
-        time.sleep(0.3 + abs(0.4 * (i % 5 - 2))) # Небольшая случайная задержка 0.1-0.5 сек
-
-    if all_products_data:
-        # Вывод отладочной информации для первого товара перед сохранением
-        if all_products_data:
-            print("\n--- Пример данных первого товара (перед записью в CSV) ---")
-            first_item = all_products_data[0]
-            print(f"URL: {first_item.get('url', 'N/A')}")
-            print(f"Title: {first_item.get('title', 'N/A')}")
-            print(f"Category: {first_item.get('category', 'N/A')}")
-            print(f"Price: {first_item.get('price', 'N/A')}")
-            print(f"Image URL: {first_item.get('image_url', 'N/A')}")
-            print(f"Short Description (очищенный HTML, начало):\n{str(first_item.get('short_description', 'N/A'))[:100]}...")
-            print(f"Full Description (очищенный HTML, начало):\n{str(first_item.get('full_description_html', 'N/A'))[:100]}...")
-            print(f"Product Details (очищенный HTML, начало):\n{str(first_item.get('product_details_html', 'N/A'))[:100]}...")
-
-        save_to_csv(all_products_data, category_folder_name, base_filename=category_folder_name) 
+            print("\nНе все страницы категорий/sitemap загрузились: удалённые товары в этом запуске не определяются.")
+        delta.close(finished=True)
+        state.close()
+        print(f"\nИнкрементальный режим: без изменений {state.unchanged_count}, "
+              f"добавлено {delta.counts['added']}, изменено {delta.counts['changed']}, удалено {delta.counts['removed']}.")
+
+    if writer.records_written:
+        print(f"Данные ({writer.records_written} товаров) сохранены в файл: {writer.path}")
     else:
+        os.remove(writer.path)
         print("Не собрано данных о товарах для сохранения.")
 
+    metrics.print_summary()
+    if METRICS_JSON_PATH: metrics.write_json(METRICS_JSON_PATH)
+    if PROFILE_PARSE_PATH: save_parse_profile(PROFILE_PARSE_PATH)
     print("\n--- Работа скрапера завершена ---")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Скрапер товаров reflex-boutique.fr")
+    arg_parser.add_argument('--resume', action='store_true',
+                            help=f"продолжить прерванный запуск по контрольной точке {CHECKPOINT_FILE}")
+    arg_parser.add_argument('--metrics-json', metavar='PATH', help="сохранить сводку метрик (p50/p95/p99 по стадиям) в JSON")
+    arg_parser.add_argument('--profile-parse', metavar='PATH', help="профилировать parse_data через cProfile и сохранить .prof")
+    arg_parser.add_argument('--download-images', action='store_true',
+                            help="скачать изображения товаров в папку категории и записать путь в image_path")
+    args = arg_parser.parse_args()
+    if args.download_images: DOWNLOAD_IMAGES = True
+    if args.metrics_json: METRICS_JSON_PATH = args.metrics_json
+    if args.profile_parse: PROFILE_PARSE_PATH = args.profile_parse
+    main(resume=args.resume)
\ No newline at end of file